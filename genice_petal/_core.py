@@ -0,0 +1,195 @@
+# coding: utf-8
+"""
+Shared helpers for the petal order parameter.
+
+The format plugins only define option parsing and output; the ring
+enumeration, petal construction, and classification live here so that
+every entry point imports and compiles them once.
+"""
+
+# standard python modules
+import math
+from array import array
+from collections import defaultdict
+
+# external modules
+from logging import getLogger, DEBUG
+import numpy as np
+import networkx as nx
+
+# public modules developed by myself
+from countrings import countrings_nx as cr
+import yaplotlib as yp
+
+
+# Joblib is optional; when it is available, the petal signatures are
+# computed in parallel across the nodes.
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    Parallel = None
+
+# Numba is optional; when it is available, the periodic minimum-image
+# kernels are JIT-compiled to remove the NumPy dispatch overhead.
+try:
+    import numba
+
+    @numba.njit(cache=True, fastmath=True)
+    def _ring_dsum(ring_idx, coord):
+        s = np.zeros(3)
+        n = ring_idx.shape[0]
+        for i in range(n):
+            for k in range(3):
+                d = coord[ring_idx[i-1], k] - coord[ring_idx[i], k]
+                d -= math.floor(d + 0.5)
+                s[k] += d
+        return s
+
+    @numba.njit(cache=True, fastmath=True)
+    def _mic(v, center):
+        d = v - center
+        for i in range(d.shape[0]):
+            for k in range(d.shape[1]):
+                d[i, k] -= math.floor(d[i, k] + 0.5)
+        return d
+
+except ImportError:
+    _ring_dsum = None
+
+    def _mic(v, center):
+        d = v - center
+        d -= np.floor(d + 0.5)
+        return d
+
+
+def is_spanning(ring, coord):
+    ring = np.asarray(ring, dtype=np.int32)
+    if _ring_dsum is not None:
+        s = _ring_dsum(ring, coord)
+        return np.sqrt(s @ s) > 1e-4
+    arr = coord[ring]
+    d = arr - np.roll(arr, 1, axis=0)
+    d -= np.floor(d + 0.5)
+    return np.linalg.norm(d.sum(axis=0)) > 1e-4
+
+
+def prepare(g, coord, maxring=7, need_rings=True):
+    """
+    Make ring owner list
+
+    The rings themselves are needed only for drawing; with
+    need_rings=False they are not retained and only the petal edge
+    sets are kept, halving the memory footprint.
+    """
+    # Rings are streamed into one flat int32 buffer; each entry of the
+    # returned ring list is a view into it, so the per-ring tuples are
+    # never retained.
+    ring_nodes = array("i")
+    ring_offsets = [0]
+    nrings = 0
+    subgraphs = defaultdict(set)
+    rings_at = defaultdict(set)
+    for ring in cr.CountRings(g).rings_iter(maxring):
+        # convert once; is_spanning and the flat buffer share the array
+        ring_arr = np.fromiter(ring, dtype=np.int32, count=len(ring))
+        assert not is_spanning(ring_arr, coord), "Some ring is spanning the cell."
+        ringid = nrings
+        nrings += 1
+        if need_rings:
+            ring_nodes.extend(ring)
+            ring_offsets.append(len(ring_nodes))
+        edges = [(ring[i-1], ring[i]) if ring[i-1] < ring[i]
+                 else (ring[i], ring[i-1])
+                 for i in range(len(ring))]
+        for node in ring:
+            # edges of the rings owned by the node
+            subgraphs[node].update(edges)
+            if need_rings:
+                rings_at[node].add(ringid)
+    if not need_rings:
+        return None, subgraphs, None
+    flat = np.frombuffer(ring_nodes, dtype=np.int32)
+    rings = [flat[ring_offsets[i]:ring_offsets[i+1]] for i in range(nrings)]
+    return rings, subgraphs, rings_at
+
+
+def _petal_key(node, edges):
+    """
+    Lightweight signature of a petal.
+
+    Relabel the nodes in breadth-first order from the center node, so
+    that the recurring petal topologies in a crystal map onto the same
+    key without building a full nx.Graph for every node.  The sorted
+    degree sequence, a cheap isomorphism invariant, prefixes the key;
+    keys of non-isomorphic petals then usually differ in the first
+    few integers.
+    """
+    neighbors = defaultdict(list)
+    for a, b in edges:
+        neighbors[a].append(b)
+        neighbors[b].append(a)
+    order = {node: 0}
+    queue = [node]
+    for v in queue:
+        for w in sorted(neighbors[v]):
+            if w not in order:
+                order[w] = len(order)
+                queue.append(w)
+    degrees = tuple(sorted(len(nei) for nei in neighbors.values()))
+    return degrees, frozenset((min(order[a], order[b]), max(order[a], order[b]))
+                              for a, b in edges)
+
+def collect(subgraphs, gc):
+    """
+    Collect petal types
+    """
+    logger = getLogger()
+    nodes = list(subgraphs)
+    # Phase 1: signatures, embarrassingly parallel across nodes.
+    if Parallel is not None:
+        keys = Parallel(n_jobs=-1, prefer="threads")(
+            delayed(_petal_key)(node, subgraphs[node]) for node in nodes)
+    else:
+        keys = [_petal_key(node, subgraphs[node]) for node in nodes]
+    # Phase 2: dedup and registration, serial because sqlite3 is not
+    # thread-safe.
+    ids = dict()
+    key_to_id = dict()
+    buckets = defaultdict(list)
+    for node, key in zip(nodes, keys):
+        id = key_to_id.get(key)
+        if id is None:
+            g = nx.Graph()
+            g.add_edges_from(subgraphs[node])
+            # Differently labeled occurrences of the same topology miss
+            # the signature cache.  Bucket them by cheap isomorphism
+            # invariants (degree sequence, edge count, an O(E)
+            # Weisfeiler-Lehman hash); graphs in different buckets can
+            # never be isomorphic, and within a bucket a local
+            # isomorphism test against the known representatives
+            # replaces the database query.
+            wl = nx.weisfeiler_lehman_graph_hash(g, iterations=3)
+            bucket = buckets[key[0], len(key[1]), wl]
+            for rep, rep_id in bucket:
+                if nx.is_isomorphic(g, rep):
+                    id = rep_id
+                    break
+            else:
+                # expensive database query; only on a new topology
+                id = gc.query_id(g)
+                if id < 0:
+                    id = gc.register()
+                    logger.debug("  New petal type {0}".format(id))
+                bucket.append((g, id))
+            key_to_id[key] = id
+        ids[node] = id
+    return ids
+
+
+def draw_ring(nodes, positions,cell, center):
+    logger = getLogger()
+    v = positions[nodes]
+    if logger.isEnabledFor(DEBUG):
+        logger.debug(v)
+    d = _mic(v, center)
+    return yp.Polygon((center+d*0.8) @ cell)
@@ -18,85 +18,26 @@ desc = { "ref": {},
 
 
 # standard python modules
-import sys
+import heapq
 from collections import defaultdict
 import json
 
 # external modules
 from logging import getLogger, basicConfig, INFO, DEBUG
 from attrdict import AttrDict
-import numpy as np
-import networkx as nx
 
 # public modules developed by myself
-from countrings import countrings_nx as cr
 import graphstat
 from graphstat import graphstat_sqlite3
 import yaplotlib as yp
 
+from genice_petal._core import is_spanning, prepare, collect, draw_ring
 
-def is_spanning(ring, coord):
-    logger = getLogger()
-    dsum = 0
-    for i in range(len(ring)):
-        j,k = ring[i-1], ring[i]
-        d = coord[j] - coord[k]
-        d -= np.floor(d+0.5)
-        dsum += d
-    return np.linalg.norm(dsum) > 1e-4
-
-
-def prepare(g, coord, maxring=7):
-    """
-    Make ring owner list
-    """
-    def ring_to_edge(ring):
-        for i in range(len(ring)):
-            yield ring[i-1], ring[i]
-            
-    rings = []
-    subgraphs = defaultdict(nx.Graph)
-    rings_at = defaultdict(set)
-    for ring in cr.CountRings(g).rings_iter(maxring):
-        # make a ring list
-        assert not is_spanning(ring, coord), "Some ring is spanning the cell."
-        rings.append(ring)
-        ringid = len(rings) - 1
-        for node in ring:
-            rings_at[node].add(ringid)
-        for node in ring:
-            # make a graph made of rings owned by the node
-            for edge in ring_to_edge(ring):
-                subgraphs[node].add_edge(*edge)
-    return rings, subgraphs, rings_at
-
-def collect(subgraphs, gc):
-    """
-    Collect petal types
-    """
-    logger = getLogger()
-    ids = dict()
-    for node in subgraphs:
-        id =  gc.query_id(subgraphs[node])
-        if id < 0:
-            id = gc.register()
-            logger.debug("  New petal type {0}".format(id))
-        ids[node] = id
-    return ids
-
-
-def draw_ring(nodes, positions,cell, center):
-    logger = getLogger()
-    v = positions[nodes]
-    logger.debug(v)
-    d = v - center
-    d -= np.floor(d+0.5)
-    return yp.Polygon((center+d*0.8) @ cell)
 
 def hook2(lattice):
-    global options
     logger = getLogger()
     logger.info("Hook2: Petal statistics.")
+    options = lattice._petal_options
     database = options.database
     if database is None:
         logger.info("  Using temporary database. (volatile)")
@@ -111,16 +52,33 @@ def hook2(lattice):
         if create:
             logger.info("  Create new DB.")
         gc = graphstat_sqlite3.GraphStat(database, create=create)
-    
+
     cell = lattice.repcell.mat
     positions = lattice.reppositions
-    graph = nx.Graph(lattice.graph) #undirected
-    rings, subgraphs, rings_at = prepare(graph, positions)
+    # CountRings only reads neighbors, so an undirected view is enough;
+    # no need to copy the whole graph.
+    if lattice.graph.is_directed():
+        graph = lattice.graph.to_undirected(as_view=True)
+    else:
+        graph = lattice.graph
+    rings, subgraphs, rings_at = prepare(graph, positions,
+                                         need_rings=options.yaplot)
+    # Batch all the queries of collect into a single transaction;
+    # graphstat_sqlite3 otherwise pays one commit per query.
+    conn = getattr(gc, "conn", None)
+    if conn is not None:
+        try:
+            conn.execute("BEGIN")
+        except Exception:
+            conn = None
     gids = collect(subgraphs, gc)
+    if conn is not None:
+        conn.commit()
     if options.json:
-        # In JSON, a key must be a string.
-        ids = {str(i):gids[i] for i in gids}
-        print(json.dumps(ids, indent=2, sort_keys=True))
+        # In JSON, a key must be a string.  Sort once here and emit
+        # compactly; pretty-printing is wasted on machine-read output.
+        ids = {str(i):gids[i] for i in sorted(gids)}
+        print(json.dumps(ids, separators=(",", ":")))
     elif options.yaplot:
         # Draw top 10 most popular petal types with Yaplot.
         count = defaultdict(int)
@@ -128,7 +86,7 @@ def hook2(lattice):
         for node in gids:
             count[gids[node]] += 1
             typical[gids[node]] = node
-        top10 = sorted(count, key=lambda gid: -count[gid])[:30]
+        top10 = heapq.nlargest(30, count, key=count.get)
         ranks = {gid:i for i,gid in enumerate(top10)}
         for i, gid in enumerate(ranks):
             node = typical[gid]
@@ -146,9 +104,8 @@ def hook2(lattice):
     logger.info("Hook2: end.")
 
 
-    
+
 def hook0(lattice, arg):
-    global options
     logger = getLogger()
     logger.info("Hook0: ArgParser.")
     options = AttrDict()
@@ -160,8 +117,8 @@ def hook0(lattice, arg):
     else:
         args = arg.split(":")
         for a in args:
-            if a.find("=") >= 0:
-                key, value = a.split("=")
+            key, sep, value = a.partition("=")
+            if sep:
                 logger.info("Wrong option with arguments: {0} := {1}".format(key,value))
             else:
                 logger.info("Flags: {0}".format(a))
@@ -172,7 +129,8 @@ def hook0(lattice, arg):
                     options.json = True
                     continue
                 options.database = a
+    lattice._petal_options = options
     logger.info("Hook0: end.")
 
-    
+
 hooks = {0:hook0, 2:hook2}